@@ -1,8 +1,289 @@
+import functools
+import math
 import pygame
 import random
 import numpy as np
+from numba import from_dtype, njit, prange, types
+try:
+    from numba import cuda
+except ImportError:  # numba builds without the CUDA target
+    cuda = None
 
 preset_colours = [(219, 255, 254), (255, 235, 205), (255, 80, 0)]
+TRAIL_LENGTH = 200000  # Limit trail length
+TRAIL_MEMORY = 64 * 2**20  # Default cap on the trail buffer, in bytes, shared by all bodies
+TRAIL_PIXEL_SPACING = 2  # Thin the drawn trail to roughly this many pixels between vertices
+ROCKET_CACHE_MAX_ZOOM = 4  # Rotated rocket images grow with zoom squared, so only cache the small ones
+MAX_SPARKS = 256
+STATE_DTYPE = np.float32  # Plenty of precision for the visualisation at half the memory of float64
+PARALLEL_THRESHOLD = 64  # Below this many bodies, thread start-up costs more than the force sum
+BH_THRESHOLD = 2048  # Above this many bodies, switch to the Barnes-Hut approximation
+BH_THETA = 0.5
+GPU_THRESHOLD = 4096  # Above this many bodies, use the CUDA direct sum when a GPU is available
+CUDA_TILE = 128  # Threads per block, and bodies staged in shared memory per tile
+
+# Compile the direct-sum kernels once, eagerly, for the state dtype rather than per call signature
+_state = from_dtype(STATE_DTYPE)
+_gravity_sig = types.void(_state[:, ::1], _state[::1], types.float64[::1], types.float64[::1],
+                          types.float64, _state[:, ::1])
+
+@njit(inline='always', fastmath=True)
+def _gravity_row(pos, mass, gscale, soft3, G, i, out):
+    # Pairwise gravity on body i; gscale and soft3 are per receiving body
+    ax = 0.0
+    ay = 0.0
+    for j in range(pos.shape[0]):
+        if i == j:
+            continue
+        dx = pos[j, 0] - pos[i, 0]
+        dy = pos[j, 1] - pos[i, 1]
+        d2 = dx*dx + dy*dy
+        inv = mass[j] / max(d2 * math.sqrt(d2), soft3[i])
+        ax += dx * inv
+        ay += dy * inv
+    out[i, 0] = G * gscale[i] * ax
+    out[i, 1] = G * gscale[i] * ay
+
+@njit(_gravity_sig, cache=True, fastmath=True)
+def _gravity(pos, mass, gscale, soft3, G, out):
+    for i in range(pos.shape[0]):
+        _gravity_row(pos, mass, gscale, soft3, G, i, out)
+
+@njit(parallel=True, cache=True, fastmath=True)
+def _gravity_parallel(pos, mass, gscale, soft3, G, out):
+    # Same as _gravity, with the receiving bodies split across threads
+    for i in prange(pos.shape[0]):
+        _gravity_row(pos, mass, gscale, soft3, G, i, out)
+
+@njit(cache=True)
+def _bh_try_build(pos, mass, capacity):
+    # Build a Barnes-Hut quadtree as flat arrays; returns a cell count of -1 if capacity runs out.
+    # A cell is either internal (children != -1) or a leaf holding one body (cell_body != -1).
+    N = pos.shape[0]
+    cell_centre = np.empty((capacity, 2))
+    cell_half = np.empty(capacity)
+    cell_mass = np.zeros(capacity)
+    cell_com = np.zeros((capacity, 2))
+    cell_body = np.full(capacity, -1)
+    child_ids = np.full((capacity, 4), -1)
+    internal = np.zeros(capacity, dtype=np.bool_)
+
+    # Root cell is a square around every body
+    min_x = max_x = pos[0, 0]
+    min_y = max_y = pos[0, 1]
+    for b in range(1, N):
+        min_x = min(min_x, pos[b, 0])
+        max_x = max(max_x, pos[b, 0])
+        min_y = min(min_y, pos[b, 1])
+        max_y = max(max_y, pos[b, 1])
+    cell_centre[0, 0] = 0.5 * (min_x + max_x)
+    cell_centre[0, 1] = 0.5 * (min_y + max_y)
+    cell_half[0] = 0.5 * max(max_x - min_x, max_y - min_y) * 1.0001 + 1e-12
+    min_half = cell_half[0] * 2.0**-40  # Bodies closer than this share a leaf
+    n_cells = 1
+
+    for b in range(N):
+        node = 0
+        cell_mass[node] += mass[b]
+        cell_com[node, 0] += mass[b] * pos[b, 0]
+        cell_com[node, 1] += mass[b] * pos[b, 1]
+        while True:
+            if not internal[node]:
+                if cell_body[node] == -1:
+                    cell_body[node] = b
+                    break
+                if cell_half[node] < min_half:
+                    break
+                # Split the occupied leaf, pushing its body down one level
+                e = cell_body[node]
+                cell_body[node] = -1
+                internal[node] = True
+                if n_cells == capacity:
+                    return -1, cell_com, cell_mass, cell_half, cell_centre, cell_body, child_ids
+                q = (pos[e, 0] >= cell_centre[node, 0]) + 2 * (pos[e, 1] >= cell_centre[node, 1])
+                c = n_cells
+                n_cells += 1
+                half = 0.5 * cell_half[node]
+                cell_half[c] = half
+                cell_centre[c, 0] = cell_centre[node, 0] + (half if q & 1 else -half)
+                cell_centre[c, 1] = cell_centre[node, 1] + (half if q & 2 else -half)
+                cell_body[c] = e
+                cell_mass[c] = mass[e]
+                cell_com[c, 0] = mass[e] * pos[e, 0]
+                cell_com[c, 1] = mass[e] * pos[e, 1]
+                child_ids[node, q] = c
+
+            q = (pos[b, 0] >= cell_centre[node, 0]) + 2 * (pos[b, 1] >= cell_centre[node, 1])
+            c = child_ids[node, q]
+            if c == -1:
+                if n_cells == capacity:
+                    return -1, cell_com, cell_mass, cell_half, cell_centre, cell_body, child_ids
+                c = n_cells
+                n_cells += 1
+                half = 0.5 * cell_half[node]
+                cell_half[c] = half
+                cell_centre[c, 0] = cell_centre[node, 0] + (half if q & 1 else -half)
+                cell_centre[c, 1] = cell_centre[node, 1] + (half if q & 2 else -half)
+                child_ids[node, q] = c
+            node = c
+            cell_mass[node] += mass[b]
+            cell_com[node, 0] += mass[b] * pos[b, 0]
+            cell_com[node, 1] += mass[b] * pos[b, 1]
+
+    for c in range(n_cells):
+        if cell_mass[c] > 0.0:
+            cell_com[c, 0] /= cell_mass[c]
+            cell_com[c, 1] /= cell_mass[c]
+    return n_cells, cell_com, cell_mass, cell_half, cell_centre, cell_body, child_ids
+
+@njit(cache=True)
+def _bh_build(pos, mass):
+    capacity = 4 * pos.shape[0] + 16
+    while True:
+        tree = _bh_try_build(pos, mass, capacity)
+        if tree[0] != -1:
+            return tree
+        capacity *= 2
+
+@njit(parallel=True, cache=True, fastmath=True)
+def _bh_gravity(pos, mass, gscale, soft3, G, theta, out):
+    # Barnes-Hut gravity: cells that look small from body i (width / distance < theta)
+    # act as a single mass at their centre of mass
+    n_cells, cell_com, cell_mass, cell_half, cell_centre, cell_body, child_ids = _bh_build(pos, mass)
+    for i in prange(pos.shape[0]):
+        x = pos[i, 0]
+        y = pos[i, 1]
+        ax = 0.0
+        ay = 0.0
+        stack = np.empty(4 * 44, dtype=np.int64)  # Up to 3 pending siblings per level, 41 levels
+        stack[0] = 0
+        top = 1
+        while top > 0:
+            top -= 1
+            c = stack[top]
+            if cell_body[c] == i:
+                continue
+            dx = cell_com[c, 0] - x
+            dy = cell_com[c, 1] - y
+            d2 = dx*dx + dy*dy
+            width = 2.0 * cell_half[c]
+            contains_i = abs(x - cell_centre[c, 0]) <= cell_half[c] and abs(y - cell_centre[c, 1]) <= cell_half[c]
+            if cell_body[c] == -1 and (contains_i or width * width >= theta * theta * d2):
+                for q in range(4):
+                    if child_ids[c, q] != -1:
+                        stack[top] = child_ids[c, q]
+                        top += 1
+                continue
+            inv = cell_mass[c] / max(d2 * math.sqrt(d2), soft3[i])
+            ax += dx * inv
+            ay += dy * inv
+        out[i, 0] = G * gscale[i] * ax
+        out[i, 1] = G * gscale[i] * ay
+
+@njit(cache=True, fastmath=True)
+def _accelerations(pos, mass, gscale, soft3, G, out):
+    if pos.shape[0] > BH_THRESHOLD:
+        _bh_gravity(pos, mass, gscale, soft3, G, BH_THETA, out)
+    elif pos.shape[0] > PARALLEL_THRESHOLD:
+        _gravity_parallel(pos, mass, gscale, soft3, G, out)
+    else:
+        _gravity(pos, mass, gscale, soft3, G, out)
+
+# Each integrator is a table of stages, one per row: drift the positions by c*dt, then kick
+# the velocities by d*dt with the forces at the new positions. A zero coefficient skips that
+# half, so a step costs one force evaluation per non-zero d
+_W1 = 1.0 / (2.0 - 2.0**(1.0 / 3.0))
+_W0 = -2.0**(1.0 / 3.0) * _W1
+_INTEGRATORS = {
+    # Velocity Verlet as kick-drift-kick
+    'verlet': np.array([[0.0, 0.5],
+                        [1.0, 0.5]]),
+    # Forest-Ruth / Yoshida 4th-order symplectic drift-kick sequence
+    'yoshida4': np.array([[0.5 * _W1, _W1],
+                          [0.5 * (_W0 + _W1), _W0],
+                          [0.5 * (_W0 + _W1), _W1],
+                          [0.5 * _W1, 0.0]]),
+}
+
+@njit(cache=True, fastmath=True)
+def _split_step(pos, vel, mass, gscale, soft3, G, dt, thrust_vec, stages, acc):
+    # One step through the stages table, updating pos and vel in place; acc is scratch
+    N = pos.shape[0]
+    for s in range(stages.shape[0]):
+        c = stages[s, 0] * dt
+        if c != 0.0:
+            for i in range(N):
+                for k in range(2):
+                    pos[i, k] += c * vel[i, k]
+        d = stages[s, 1] * dt
+        if d != 0.0:
+            _accelerations(pos, mass, gscale, soft3, G, acc)
+            for i in range(N):
+                for k in range(2):
+                    vel[i, k] += d * (acc[i, k] + thrust_vec[i, k])
+
+@njit(cache=True)
+def _record_trail(pos, hist, hist_idx, record):
+    # Write the positions of the bodies flagged in record as the next row of the hist ring
+    # buffer; hist_idx[0] counts the rows recorded so far
+    row = hist_idx[0] % hist.shape[0]
+    for i in range(pos.shape[0]):
+        if record[i]:
+            hist[row, i, 0] = pos[i, 0]
+            hist[row, i, 1] = pos[i, 1]
+    hist_idx[0] += 1
+
+@njit(cache=True, fastmath=True)
+def _integrate_steps(pos, vel, mass, gscale, soft3, G, dt, thrust_vec, n, stages,
+                     hist, hist_idx, record, record_every):
+    # n integrator steps without returning to Python in between, recording the trail every
+    # record_every steps (never if 0)
+    acc = np.empty_like(pos)
+    for step in range(1, n + 1):
+        _split_step(pos, vel, mass, gscale, soft3, G, dt, thrust_vec, stages, acc)
+        if record_every > 0 and step % record_every == 0:
+            _record_trail(pos, hist, hist_idx, record)
+
+if cuda is not None:
+    @cuda.jit(fastmath=True)
+    def _gravity_cuda(pos, mass, gscale, soft3, G, out):
+        # Direct sum with one thread per receiving body; each block stages CUDA_TILE bodies
+        # at a time in shared memory so every thread reads them from there
+        tile = cuda.shared.array((CUDA_TILE, 3), dtype=_state)
+        tx = cuda.threadIdx.x
+        i = cuda.grid(1)
+        N = pos.shape[0]
+        x = 0.0
+        y = 0.0
+        if i < N:
+            x = pos[i, 0]
+            y = pos[i, 1]
+        ax = 0.0
+        ay = 0.0
+        for start in range(0, N, CUDA_TILE):
+            # Every thread helps load the tile, even those past the last body,
+            # so none can skip the barriers
+            j = start + tx
+            if j < N:
+                tile[tx, 0] = pos[j, 0]
+                tile[tx, 1] = pos[j, 1]
+                tile[tx, 2] = mass[j]
+            cuda.syncthreads()
+            if i < N:
+                for k in range(min(CUDA_TILE, N - start)):
+                    if start + k == i:
+                        continue
+                    dx = tile[k, 0] - x
+                    dy = tile[k, 1] - y
+                    d2 = dx*dx + dy*dy
+                    inv = tile[k, 2] / max(d2 * math.sqrt(d2), soft3[i])
+                    ax += dx * inv
+                    ay += dy * inv
+            cuda.syncthreads()
+        if i < N:
+            out[i, 0] = G * gscale[i] * ax
+            out[i, 1] = G * gscale[i] * ay
+
 # New Star class
 class Star:
     def __init__(self, x, y, z, brightness):
@@ -35,103 +316,220 @@ class Star:
 
         pygame.draw.circle(win, (color, color, color), (int(x), int(y)), size)
 
+class SystemField:
+    # Body attribute that lives in a row of its System's arrays once the body is attached
+    def __init__(self, array_name):
+        self.array_name = array_name
+
+    def __set_name__(self, owner, name):
+        self.local_name = '_' + name
+
+    def __get__(self, body, owner=None):
+        if body is None:
+            return self
+        if body._system is None:
+            return getattr(body, self.local_name)
+        return getattr(body._system, self.array_name)[body._idx]
+
+    def __set__(self, body, value):
+        if body._system is None:
+            setattr(body, self.local_name, value)
+        else:
+            getattr(body._system, self.array_name)[body._idx] = value
+
 class Body:
+    mass = SystemField('masses')
+    position = SystemField('positions')
+    velocity = SystemField('velocities')
+    thrust = SystemField('thrust')
+    angle = SystemField('angle')
+
+    # Surfaces depend only on colour, so every body of a colour shares one
+    _glow_cache = {}
+    _rocket_cache = {}
+
+    @classmethod
+    def glow_surface_for(cls, colour):
+        glow_surface = cls._glow_cache.get(colour)
+        if glow_surface is None:
+            glow_size = 200
+            glow_surface = pygame.Surface((glow_size, glow_size), pygame.SRCALPHA)
+
+            glow_x = glow_size / 2
+            glow_y = glow_x
+
+            for radius, alpha in zip(range(67, 0, -5), range(1, 30, 5)):
+                pygame.draw.circle(glow_surface, (*colour, alpha), (glow_x, glow_y), radius)
+            cls._glow_cache[colour] = glow_surface
+        return glow_surface
+
+    @classmethod
+    def rocket_surface_for(cls, colour):
+        rocket_image = cls._rocket_cache.get(colour)
+        if rocket_image is None:
+            rocket_image = pygame.Surface((20, 40), pygame.SRCALPHA)
+            pygame.draw.polygon(rocket_image, colour, [(10, 0), (0, 40), (20, 40)])
+            cls._rocket_cache[colour] = rocket_image
+        return rocket_image
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def rotated_rocket_for(rocket_image, angle, zoom):
+        # The angle only moves in 5 degree steps, so a handful of resampled images covers every frame
+        return pygame.transform.rotozoom(rocket_image, angle, zoom)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def spark_sprite_for(colour, radius):
+        spark = pygame.Surface((2 * radius, 2 * radius), pygame.SRCALPHA)
+        pygame.draw.circle(spark, colour, (radius, radius), radius)
+        return spark
+
     def __init__(self, mass, position, velocity, is_rocket=False):
+        self._system = None
+        self._idx = None
         self.mass = mass
-        self.position = np.array(position)
-        self.velocity = np.array(velocity)
+        self.position = np.array(position, dtype=np.float64)
+        self.velocity = np.array(velocity, dtype=np.float64)
         self.colour = preset_colours[2] if not is_rocket else (0, 0, 200)
         self.is_rocket = is_rocket
         self.thrust = 0.0001 if is_rocket else 0
         self.angle = 0 if is_rocket else None
-        self.sparks = []
+        self._spark_xy = np.empty((MAX_SPARKS, 2))
+        self._spark_speed = np.empty(MAX_SPARKS)
+        self._spark_angle = np.empty(MAX_SPARKS)
+        self._spark_life = np.empty(MAX_SPARKS, dtype=np.int64)
+        self._spark_count = 0
+        self._heading_angle = None
+        self._heading = (0.0, 1.0)
+        self.glow_surface = Body.glow_surface_for(self.colour)
+        if is_rocket:
+            # Render the rocket sprite now rather than on the first frame
+            self._base_rocket_img = Body.rocket_surface_for(self.colour)
 
-        glow_size = 200
-        self.glow_surface = pygame.Surface((glow_size, glow_size), pygame.SRCALPHA)
-    
-        glow_x = glow_size / 2
-        glow_y = glow_x
+    @property
+    def position_history(self):
+        return self.trail()
 
-        for radius, alpha in zip(range(67, 0, -5), range(1, 30, 5)):
-            pygame.draw.circle(self.glow_surface, (*self.colour, alpha), (glow_x, glow_y), radius)
-        
-        self.position_history = []
-
-    def draw(self, win, rocket_pos, scale):
-        # Calculate the relative position of the current body to the rocket
-        relative_position = self.position - rocket_pos
-
-        # Scale and translate the positions so the rocket is always in the center
-        x = relative_position[0] * scale + win.get_width() // 2
-        y = win.get_height() // 2 - (relative_position[1] * scale)
+    def trail(self, stride=1):
+        if self._system is None:
+            return np.empty((0, 2), dtype=STATE_DTYPE)
+        return self._system.trail(self._idx, stride)
 
+    def draw(self, win, x, y, scale):
+        # x, y is the body's screen position (as Python floats, since pygame rejects float32 coordinates)
         if self.is_rocket:
             if self.thrust > 0:
-                self.draw_sparks(win, x +  20 * np.sin(np.radians(self.angle))*scale/10000, y +  20 * np.cos(np.radians(self.angle))*scale/10000, scale/10000)
+                sin_a, cos_a = self.heading()
+                self.draw_sparks(win, x +  20 * sin_a*scale/10000, y +  20 * cos_a*scale/10000, scale/10000)
 
-            rocket_image = pygame.Surface((20, 40), pygame.SRCALPHA)
-            pygame.draw.polygon(rocket_image, self.colour, [(10, 0), (0, 40), (20, 40)])
-            rocket_image = pygame.transform.rotozoom(rocket_image, self.angle, scale/10000)  # Scale the rocket image
+            # Scale the rocket image. The +/- keys zoom in x1.1 steps, so snap to the nearest step;
+            # float drift from repeated zooming then maps back onto the same cache key
+            zoom = 1.1 ** round(math.log(scale / 10000, 1.1))
+            if zoom <= ROCKET_CACHE_MAX_ZOOM:
+                rocket_image = Body.rotated_rocket_for(self._base_rocket_img, int(self.angle) % 360, zoom)
+            else:
+                rocket_image = pygame.transform.rotozoom(self._base_rocket_img, self.angle, zoom)
             win.blit(rocket_image, rocket_image.get_rect(center=(x, y)))
 
         else:
-            win.blit(self.glow_surface, (x - self.glow_surface.get_width() // 2, y - self.glow_surface.get_height() // 2))
-            pygame.draw.circle(win, self.colour, (x, y), scale/15) # draw planet
+            # Skip planets whose glow and disc are both fully off-screen
+            margin = max(self.glow_surface.get_width() // 2, scale/15)
+            if -margin <= x <= win.get_width() + margin and -margin <= y <= win.get_height() + margin:
+                win.blit(self.glow_surface, (x - self.glow_surface.get_width() // 2, y - self.glow_surface.get_height() // 2))
+                pygame.draw.circle(win, self.colour, (x, y), scale/15) # draw planet
 
         # Draw trail
-        if len(self.position_history) > 2 and not self.is_rocket:
-            points = []
-            for pos in self.position_history:
-                rel_pos = pos - rocket_pos
-                trail_x = rel_pos[0] * scale + win.get_width() // 2
-                trail_y = win.get_height() // 2 - (rel_pos[1] * scale)
-                points.append((trail_x, trail_y))
-            pygame.draw.lines(win, self.colour, False, points, 2)
+        if not self.is_rocket and self._system is not None:
+            # Vertices closer together than a couple of pixels are indistinguishable, so keep
+            # every stride-th record, with a power-of-two stride picked from the on-screen step
+            step = self._system.trail_step_length(self._idx) * scale
+            stride = 1
+            if step > 0:
+                stride = 2 ** max(0, int(math.log2(TRAIL_PIXEL_SPACING / step)))
+
+            # Only the pieces of the full trail near the window are read and drawn; the margin
+            # covers a few steps so a segment cutting across a corner is not lost
+            margin = 2 + 4 * step
+            width, height = win.get_width(), win.get_height()
+            px, py = self.position.astype(np.float64)
+            lo = (px - (x + margin) / scale, py - (height - y + margin) / scale)
+            hi = (px + (width - x + margin) / scale, py + (y + margin) / scale)
+            for run in self._system.trail_runs(self._idx, lo, hi, stride):
+                rel_pos = run.astype(np.float64) - (px, py)
+                points = np.column_stack((rel_pos[:, 0] * scale + x, y - rel_pos[:, 1] * scale))
+                pygame.draw.lines(win, self.colour, False, points, 2)
 
     def draw_sparks(self, win, x, y, scale):
+        n = self._spark_count
+
         # Create new sparks
-        for _ in range(5):  # Add 5 new sparks each frame
-            spark_x = x 
-            spark_y = y 
-            spark_speed = random.uniform(1, 3) * scale
-            spark_angle = self.angle + random.uniform(-30, 30)
-            spark_life = random.randint(10, 20)
-            self.sparks.append([(spark_x, spark_y), spark_speed, spark_angle, spark_life])
-
-        # Update and draw existing sparks
-        new_sparks = []
-        for spark in self.sparks:
-            pos, speed, angle, life = spark
-            # Move the spark
-            new_x = pos[0] + speed * np.sin(np.radians(angle))
-            new_y = pos[1] + speed * np.cos(np.radians(angle))
-            # Decrease life and add to new list if still alive
-            life -= 1
-            if life > 0:
-                new_sparks.append([(new_x, new_y), speed, angle, life])
-                # Draw the spark
-                color = (255, 255, 0) if life > 10 else (255, 165, 0)  # Yellow fading to orange
-                pygame.draw.circle(win, color, (int(new_x), int(new_y)), max(2 * scale, 1))
-
-        self.sparks = new_sparks
+        new = min(5, MAX_SPARKS - n)  # Add 5 new sparks each frame
+        self._spark_xy[n:n + new] = (x, y)
+        self._spark_speed[n:n + new] = np.random.uniform(1, 3, new) * scale
+        self._spark_angle[n:n + new] = self.angle + np.random.uniform(-30, 30, new)
+        self._spark_life[n:n + new] = np.random.randint(10, 21, new)
+        n += new
+
+        # Move every spark and decrease its life
+        angle = np.radians(self._spark_angle[:n])
+        self._spark_xy[:n, 0] += self._spark_speed[:n] * np.sin(angle)
+        self._spark_xy[:n, 1] += self._spark_speed[:n] * np.cos(angle)
+        self._spark_life[:n] -= 1
+
+        # Compact the sparks that are still alive to the front of the arrays
+        alive = self._spark_life[:n] > 0
+        n = int(np.count_nonzero(alive))
+        for spark_array in (self._spark_xy, self._spark_speed, self._spark_angle, self._spark_life):
+            spark_array[:n] = spark_array[:len(alive)][alive]
+        self._spark_count = n
+
+        # Draw the sparks as one batched blit of prerendered dots
+        radius = int(max(2 * scale, 1))
+        yellow = Body.spark_sprite_for((255, 255, 0), radius)
+        orange = Body.spark_sprite_for((255, 165, 0), radius)
+        blits = [(yellow if life > 10 else orange, (spark_x - radius, spark_y - radius))  # Yellow fading to orange
+                 for (spark_x, spark_y), life in zip(self._spark_xy[:n].astype(int).tolist(), self._spark_life[:n].tolist())]
+        # fblits needs pygame 2.1.3+
+        getattr(win, 'fblits', win.blits)(blits)
 
     def compute_acceleration(self, other_bodies, G=1.0, softening=0.18):
-        acceleration = np.zeros(2)
+        # Standalone per-body version of the System kernels; System itself never calls this
+        if self.is_rocket:
+            G = 4*G
+            softening = softening / 3
+        soft3 = softening**3
+
+        # Plain float math: a 2-vector is far too small to be worth a ufunc dispatch
+        x, y = self.position.tolist()
+        ax = 0.0
+        ay = 0.0
         for other in other_bodies:
             if other is not self:
-                r = other.position - self.position
-                distance = np.linalg.norm(r)
-                if not self.is_rocket:
-                    acceleration += G * other.mass * r / np.maximum(distance**3, softening**3)
-                else:
-                    acceleration +=  4*G * other.mass * r / np.maximum(distance**3, (softening/3)**3)
-        
+                ox, oy = other.position.tolist()
+                dx = ox - x
+                dy = oy - y
+                d2 = dx*dx + dy*dy
+                inv = float(other.mass) / max(d2 * math.sqrt(d2), soft3)
+                ax += dx * inv
+                ay += dy * inv
+        ax *= G
+        ay *= G
+
         if self.is_rocket:
-            thrust_acceleration = np.array([-self.thrust * np.sin(np.radians(self.angle)),
-                                            self.thrust * np.cos(np.radians(self.angle))])
-            acceleration += thrust_acceleration
-        
-        return acceleration
+            sin_a, cos_a = self.heading()
+            ax -= float(self.thrust) * sin_a
+            ay += float(self.thrust) * cos_a
+
+        return np.array([ax, ay])
+
+    def heading(self):
+        # sin/cos of the rocket angle, only recomputed when the angle changes
+        if self.angle != self._heading_angle:
+            angle = math.radians(self.angle)
+            self._heading = (math.sin(angle), math.cos(angle))
+            self._heading_angle = self.angle
+        return self._heading
 
     def get_state(self):
         state = np.array([self.position[0], self.position[1], self.velocity[0], self.velocity[1]])
@@ -151,8 +549,13 @@ class Body:
                 self.velocity = 0
 
 class System:
-    def __init__(self, G=1.0, state=None, bodies=None):
+    def __init__(self, G=1.0, state=None, bodies=None, softening=0.18, integrator='verlet',
+                 trail_length=None):
+        if integrator not in _INTEGRATORS:
+            raise ValueError(f'Unknown integrator {integrator!r}')
         self.G = G
+        self.softening = softening
+        self.integrator = integrator
         if state is not None:
             self.bodies = []
             for body in range(int(len(state)/4)):
@@ -161,11 +564,127 @@ class System:
         else:
             self.bodies = bodies
 
+        # Simulation state lives here as contiguous arrays; each Body is a view into one row
+        N = len(self.bodies)
+        self.positions = np.empty((N, 2), dtype=STATE_DTYPE)
+        self.velocities = np.empty((N, 2), dtype=STATE_DTYPE)
+        self.masses = np.empty(N, dtype=STATE_DTYPE)
+        self.thrust = np.zeros(N)
+        self.angle = np.zeros(N)
+        self.is_rocket = np.zeros(N, dtype=bool)
+
+        for i, body in enumerate(self.bodies):
+            self.positions[i] = body.position
+            self.velocities[i] = body.velocity
+            self.masses[i] = body.mass
+            self.is_rocket[i] = body.is_rocket
+            if body.is_rocket:
+                self.thrust[i] = body.thrust
+                self.angle[i] = body.angle
+            body._system = self
+            body._idx = i
+
+        # The rocket feels 4x gravity with a tighter softening radius
+        self._gscale = np.where(self.is_rocket, 4.0, 1.0)
+        self._soft3 = np.where(self.is_rocket, (self.softening / 3)**3, self.softening**3)
+        self._rockets = np.flatnonzero(self.is_rocket).tolist()
+
+        # Large systems run their force sum on the GPU; the per-body constants stay on the device
+        self._use_cuda = N > GPU_THRESHOLD and cuda is not None and cuda.is_available()
+        if self._use_cuda:
+            # Masses can change through body.mass, so they are uploaded with the positions
+            self._cuda_consts = (cuda.to_device(self._gscale), cuda.to_device(self._soft3))
+
+        # Trail ring buffer shared by all bodies, written from inside the integrator kernel.
+        # Unless given, its length is capped so the buffer fits in TRAIL_MEMORY however many
+        # bodies there are; a length of 0 turns recording off. GPU-sized systems record nothing
+        # by default, since their steps run from Python and each row is a gather over every body.
+        # The rocket's trail is never drawn, so it is not recorded
+        if trail_length is None and self._use_cuda:
+            trail_length = 0
+        elif trail_length is None:
+            trail_length = min(TRAIL_LENGTH, TRAIL_MEMORY // (max(N, 1) * 2 * np.dtype(STATE_DTYPE).itemsize))
+        self._hist = np.empty((trail_length, N, 2), dtype=STATE_DTYPE)
+        self._hist_idx = np.zeros(1, dtype=np.int64)
+        self._record = ~self.is_rocket
+
+        # Compile the kernels up front rather than on the first frame (a zero step is a no-op)
+        self._step(0.0, 1, 0)
+
+    def _trail_span(self, i):
+        # Absolute record numbers [first, end) of body i still held in the ring
+        end = int(self._hist_idx[0]) if self._record[i] else 0
+        return max(0, end - len(self._hist)), end
+
+    def _trail_records(self, first, end, stride):
+        # Record numbers in [first, end) that are multiples of stride
+        return np.arange(-(-first // stride) * stride, end, stride)
+
+    def trail(self, i, stride=1):
+        # Recorded positions of body i, oldest first. With a stride, only records whose
+        # absolute number is a multiple of it are read, plus the newest; those stay put as
+        # the ring advances, so a thinned trail does not shimmer from frame to frame
+        first, end = self._trail_span(i)
+        if stride == 1 and end <= len(self._hist):
+            return self._hist[first:end, i]
+        records = self._trail_records(first, end, stride)
+        if end > first and (len(records) == 0 or records[-1] != end - 1):
+            records = np.append(records, end - 1)
+        return self._hist[records % len(self._hist), i]
+
+    def trail_runs(self, i, lo, hi, stride=1):
+        # Contiguous pieces of body i's trail with points inside the box lo..hi, found with
+        # one mask over the full-resolution ring and then thinned like trail(), keeping the
+        # ends of each piece. Each piece starts and ends one record outside the box
+        first, end = self._trail_span(i)
+        if end - first < 2:
+            return []
+        xs, ys = self._hist[:min(end, len(self._hist)), i].T
+        inside = (xs >= lo[0]) & (xs <= hi[0]) & (ys >= lo[1]) & (ys <= hi[1])
+        # Reorder the ring so offset k holds record first + k
+        inside = np.roll(inside, -(first % len(self._hist)))
+        keep = inside.copy()
+        keep[1:] |= inside[:-1]
+        keep[:-1] |= inside[1:]
+        offsets = np.flatnonzero(keep)
+        runs = []
+        for run in np.split(offsets, np.flatnonzero(np.diff(offsets) != 1) + 1):
+            if len(run) < 2:
+                continue
+            start, stop = first + run[0], first + run[-1]
+            records = self._trail_records(start + 1, stop, stride)
+            records = np.concatenate(([start], records, [stop]))
+            runs.append(self._hist[records % len(self._hist), i])
+        return runs
+
+    def trail_step_length(self, i):
+        # Average world distance between consecutive records of body i, measured over
+        # coarse samples at fixed record numbers so it barely moves from frame to frame
+        first, end = self._trail_span(i)
+        stride = 1024 if end - first > 8 * 1024 else 1
+        records = self._trail_records(first, end, stride)
+        if len(records) < 2:
+            return 0.0
+        points = self._hist[records % len(self._hist), i].astype(np.float64)
+        path = np.sqrt(((points[1:] - points[:-1])**2).sum(axis=1)).sum()
+        return float(path) / (records[-1] - records[0])
+
+    def thrust_accelerations(self):
+        # Rocket thrust along its heading; planets never thrust
+        thrust_vec = np.zeros((len(self.bodies), 2))
+        for i in self._rockets:
+            sin_a, cos_a = self.bodies[i].heading()
+            thrust_vec[i, 0] = -self.thrust[i] * sin_a
+            thrust_vec[i, 1] = self.thrust[i] * cos_a
+        return thrust_vec
+
     def compute_accelerations(self):
-        accelerations = []
-        for body in self.bodies:
-            other_bodies = [b for b in self.bodies if b is not body]
-            accelerations.append(body.compute_acceleration(other_bodies, self.G))
+        accelerations = np.empty_like(self.positions)
+        if self._use_cuda:
+            self._cuda_accelerations(accelerations)
+        else:
+            _accelerations(self.positions, self.masses, self._gscale, self._soft3, self.G, accelerations)
+        accelerations += self.thrust_accelerations()
         return accelerations
 
     def get_state(self):
@@ -175,19 +694,45 @@ class System:
             state.extend(body_state)
         return np.array(state)
 
+    def _cuda_accelerations(self, out):
+        d_gscale, d_soft3 = self._cuda_consts
+        d_out = cuda.device_array_like(out)
+        blocks = (len(self.bodies) + CUDA_TILE - 1) // CUDA_TILE
+        _gravity_cuda[blocks, CUDA_TILE](cuda.to_device(self.positions), cuda.to_device(self.masses),
+                                         d_gscale, d_soft3, float(self.G), d_out)
+        d_out.copy_to_host(out)
+
+    def _step_cuda(self, dt, n, record_every):
+        # Same stages and trail recording as _integrate_steps, driven from Python so each force
+        # evaluation can be launched on the GPU
+        thrust_vec = self.thrust_accelerations()
+        acc = np.empty_like(self.positions)
+        for step in range(1, n + 1):
+            for c, d in _INTEGRATORS[self.integrator]:
+                if c != 0.0:
+                    self.positions += c * dt * self.velocities
+                if d != 0.0:
+                    self._cuda_accelerations(acc)
+                    self.velocities += d * dt * (acc + thrust_vec)
+            if record_every > 0 and step % record_every == 0:
+                _record_trail(self.positions, self._hist, self._hist_idx, self._record)
+
+    def _step(self, dt, n, record_every):
+        if len(self._hist) == 0:
+            record_every = 0
+        if self._use_cuda:
+            self._step_cuda(dt, n, record_every)
+            return
+        _integrate_steps(self.positions, self.velocities, self.masses, self._gscale, self._soft3,
+                         self.G, dt, self.thrust_accelerations(), n, _INTEGRATORS[self.integrator],
+                         self._hist, self._hist_idx, self._record, record_every)
+
     def integrate(self, dt):
-        accelerations = self.compute_accelerations()
-        
-        for i, body in enumerate(self.bodies):
-            body.position += body.velocity * dt + 0.5 * accelerations[i] * dt**2
+        self.integrate_n(dt, 1)
 
-        new_accelerations = self.compute_accelerations()
-        
-        for i, body in enumerate(self.bodies):
-            body.velocity += 0.5 * (accelerations[i] + new_accelerations[i]) * dt
-            body.position_history.append(body.position.copy())
-            if len(body.position_history) > 200000:  # Limit trail length
-                body.position_history.pop(0)
+    def integrate_n(self, dt, n):
+        # Advance n steps of dt in compiled code, recording the trail once at the end
+        self._step(dt, n, n)
 
 def generate():
     body1 = Body(mass=1.0, position=[0.0, 0.0], velocity=[0.687546, 1.06785])
@@ -238,8 +783,13 @@ def pygame_run(system):
             scale *= 1.1
         if keys[pygame.K_MINUS]:
             scale /= 1.1
-        for body in system.bodies:
-            body.draw(WIN, rocket_pos, scale)
+
+        # Scale and translate every body at once so the rocket is always in the center
+        relative_positions = system.positions.astype(np.float64) - rocket_pos
+        xs = (relative_positions[:, 0] * scale + WIN.get_width() // 2).tolist()
+        ys = (WIN.get_height() // 2 - relative_positions[:, 1] * scale).tolist()
+        for body, x, y in zip(system.bodies, xs, ys):
+            body.draw(WIN, x, y, scale)
 
         # Draw the coordinate label
         position_text = font.render(f'X: {rocket_pos[0]:.5f}, Y: {rocket_pos[1]:.5f}', True, (255, 255, 255))